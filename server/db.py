@@ -2,15 +2,29 @@
 from __future__ import annotations
 
 import os
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Optional
+import threading
+from typing import Iterator, NamedTuple, Optional
 
-from sqlalchemy import Column, Integer, String, LargeBinary, DateTime, func, create_engine
+from cachetools import TTLCache
+
+from sqlalchemy import Column, Integer, String, LargeBinary, DateTime, func, create_engine, select
 from sqlalchemy.orm import declarative_base, sessionmaker, Session
 
+from mschap import MSCHAPv2
+
 Base = declarative_base()
 
 
+class NtCredentials(NamedTuple):
+    """
+    Данные пользователя, нужные для проверки NT-Response.
+    """
+    nt_hash: bytes                  # 16 байт
+    nt_des_keys: bytes              # 24 байта, вычисляются из nt_hash при чтении
+
+
 class User(Base):
     __tablename__ = "users"
 
@@ -40,11 +54,24 @@ class Database:
     """
     Класс над SQLAlchemy.
     """
+    NT_CACHE_TTL = 30          # секунд; удаление или смена nt_hash напрямую в БД видны не позже
+    NT_CACHE_SIZE = 4096
 
     def __init__(self, config: Optional[DatabaseConfig] = None):
         self.config = config or DatabaseConfig()
-        self.engine = create_engine(self.config.url, echo=False, future=True)
+        self.engine = create_engine(
+            self.config.url,
+            echo=False,
+            future=True,
+            pool_size=20,          # соединения переиспользуются между запросами
+            pool_pre_ping=False,   # без лишнего SELECT 1 на каждый checkout
+            pool_recycle=3600,
+        )
         self.SessionLocal = sessionmaker(bind=self.engine, autocommit=False, autoflush=False, future=True)
+        # username -> NtCredentials (хеш и выведенные из него DES-ключи);
+        # TTL ограничивает, как долго действуют старые данные после правки users в БД
+        self._nt_cache: TTLCache[str, NtCredentials] = TTLCache(maxsize=self.NT_CACHE_SIZE, ttl=self.NT_CACHE_TTL)
+        self._nt_cache_lock = threading.Lock()
 
     def init_db(self) -> None:
         Base.metadata.create_all(bind=self.engine)
@@ -52,15 +79,77 @@ class Database:
     def get_session(self) -> Session:
         return self.SessionLocal()
 
+    def request_session(self) -> Iterator[Session]:
+        """
+        FastAPI-зависимость: одна сессия на весь HTTP-запрос.
+        """
+        session = self.get_session()
+        try:
+            yield session
+        finally:
+            session.close()
+
+    @contextmanager
+    def _use_session(self, session: Optional[Session]) -> Iterator[Session]:
+        # сессия запроса, если её передали, иначе — своя короткая сессия
+        if session is not None:
+            yield session
+        else:
+            with self.get_session() as own_session:
+                yield own_session
+
     # high-level методы
     def get_user_by_username(self, username: str) -> Optional[User]:
         with self.get_session() as session:
             return session.query(User).filter_by(username=username).first()
 
-    def create_user(self, username: str, nt_hash: bytes) -> User:
-        with self.get_session() as session:
+    def user_exists(self, username: str, session: Optional[Session] = None) -> bool:
+        with self._use_session(session) as session:
+            stmt = select(User.id).where(User.username == username)
+            return session.execute(stmt).scalar_one_or_none() is not None
+
+    def get_cached_nt_credentials(self, username: str) -> Optional[NtCredentials]:
+        """
+        Только кеш, без обращения к БД: можно вызывать прямо из event loop.
+        """
+        with self._nt_cache_lock:
+            return self._nt_cache.get(username)
+
+    def get_nt_credentials(self, username: str, session: Optional[Session] = None) -> Optional[NtCredentials]:
+        """
+        NT-хеш и DES-ключи пользователя без загрузки ORM-объекта целиком.
+        Найденные записи вместе с DES-ключами кешируются на NT_CACHE_TTL секунд,
+        отсутствие пользователя — нет.
+        """
+        cached = self.get_cached_nt_credentials(username)
+        if cached is not None:
+            return cached
+
+        with self._use_session(session) as session:
+            stmt = select(User.nt_hash).where(User.username == username)
+            nt_hash = session.execute(stmt).scalar_one_or_none()
+        if nt_hash is None:
+            return None
+
+        # DES-ключи всегда выводятся из только что прочитанного хеша и в БД не хранятся
+        credentials = NtCredentials(nt_hash=nt_hash, nt_des_keys=MSCHAPv2.expand_nt_hash_keys(nt_hash))
+        with self._nt_cache_lock:
+            self._nt_cache[username] = credentials
+        return credentials
+
+    def create_user(
+        self,
+        username: str,
+        nt_hash: bytes,
+        session: Optional[Session] = None,
+    ) -> User:
+        with self._use_session(session) as session:
             user = User(username=username, nt_hash=nt_hash)
             session.add(user)
             session.commit()
             session.refresh(user)
-            return user
+        # если запись с тем же именем удалили в БД и пользователь зарегистрировался заново,
+        # в кеше ещё может лежать старый хеш
+        with self._nt_cache_lock:
+            self._nt_cache.pop(username, None)
+        return user
@@ -1,7 +1,13 @@
 # protocol.py
 from __future__ import annotations
+import functools
 import hashlib
-from des import DES
+import hmac
+import threading
+from typing import Callable, Optional
+
+from cryptography.hazmat.decrepit.ciphers.algorithms import TripleDES
+from cryptography.hazmat.primitives.ciphers import Cipher, modes
 
 
 class MSCHAPv2:
@@ -19,9 +25,9 @@ class MSCHAPv2:
         Упрощённый NT-хеш
         """
         pw_bytes = password.encode("utf-16le")
-        h = hashlib.md5()      # можно заменить на любой другой (sha1, sha256, и т.д.)
-        h.update(pw_bytes)
-        return h.digest()      # 16 байт, как и у настоящего NT-хеша
+        # MD5, а не MD4: клиент (MSCHAPCrypto.ts) считает тот же MD5,
+        # и уже сохранённые в БД хеши получены именно им
+        return hashlib.md5(pw_bytes).digest()  # 16 байт, как и у настоящего NT-хеша
 
     @staticmethod
     def challenge_hash(peer_challenge: bytes, auth_challenge: bytes, username: str) -> bytes:
@@ -34,11 +40,11 @@ class MSCHAPv2:
         if len(peer_challenge) != 16 or len(auth_challenge) != 16:
             raise ValueError("peer_challenge и auth_challenge должны быть по 16 байт")
 
-        sha = hashlib.sha1()
-        sha.update(peer_challenge)
-        sha.update(auth_challenge)
-        sha.update(username.encode("ascii"))  # в спецификации username в ASCII
-        return sha.digest()[:8]  # 8 байт, которые идут в DES
+        # в спецификации username в ASCII; всё сообщение хешируется одним вызовом.
+        # 32 байта challenge + username до 23 байт укладываются в один блок SHA-1
+        # (64 байта с учётом дополнения), т.е. в одно сжатие.
+        data = peer_challenge + auth_challenge + username.encode("ascii")
+        return hashlib.sha1(data).digest()[:8]  # 8 байт, которые идут в DES
 
     # ---------- Работа с DES-ключами (7 байт -> 8 байт с чётностью) ----------
 
@@ -48,8 +54,11 @@ class MSCHAPv2:
         Берём 7-битное значение и добавляем 1 бит чётности DES.
         """
         b7 &= 0x7F
-        ones = bin(b7).count("1")
-        parity_bit = 1 if (ones % 2 == 0) else 0  # odd parity: если единиц чётное, добавляем 1
+        # свёртка XOR: младший бит p — чётность числа единиц в b7
+        p = b7 ^ (b7 >> 4)
+        p ^= p >> 2
+        p ^= p >> 1
+        parity_bit = ~p & 1  # odd parity: если единиц чётное, добавляем 1
         return ((b7 << 1) | parity_bit) & 0xFF
 
     @classmethod
@@ -64,39 +73,70 @@ class MSCHAPv2:
         # интерпретируем 7 байт как один 56-битный big-endian integer
         key56 = int.from_bytes(seven, "big")
 
-        out = bytearray(8)
-        for i in range(8):
-            # берём очередные 7 бит из key56 (слева направо)
-            shift = 7 * (7 - i)
-            segment = (key56 >> shift) & 0x7F
-            out[i] = cls._apply_des_parity_to_7bits(segment)
-
-        return bytes(out)
+        # берём очередные 7 бит из key56 (слева направо) и достаём
+        # готовый байт с битом чётности из таблицы _PARITY
+        return bytes(_PARITY[(key56 >> shift) & 0x7F] for shift in _SEGMENT_SHIFTS)
 
     # ---------- NT-Response (ядро MS-CHAPv2) ----------
 
     @classmethod
-    def challenge_response(cls, challenge8: bytes, nt_hash: bytes) -> bytes:
+    def expand_nt_hash_keys(cls, nt_hash: bytes) -> bytes:
         """
-        NT-Response (24 байта) из RFC 2759:
+        Раскладывает NT-хеш на 3 DES-ключа (3 * 8 = 24 байта).
+        Ключи зависят только от NT-хеша, поэтому их можно вычислить
+        один раз при регистрации и хранить рядом с хешем.
         """
-        if len(challenge8) != 8:
-            raise ValueError("challenge8 должен быть 8 байт")
         if len(nt_hash) != 16:
             raise ValueError("NT hash должен быть 16 байт")
 
-        # 1. 16 байт NT hash + 5 нулей = 21 байт
-        z = nt_hash + b"\x00" * 5
+        # 16 байт NT hash + 5 нулей = 21 байт = 168 бит: один big-endian integer,
+        # из которого сразу берутся все 24 сегмента по 7 бит (3 ключа * 8 байт).
+        # Результат тот же, что у 3 вызовов make_des_key_from_7_bytes, но без срезов.
+        z = int.from_bytes(nt_hash, "big") << 40
+        return bytes(_PARITY[(z >> shift) & 0x7F] for shift in _NT_KEY_SHIFTS)
 
-        # 2–4. 3 * (7 байт -> DES-ключ -> DES(challenge8))
-        resp = b""
-        for i in range(3):
-            seven = z[i * 7:(i + 1) * 7]          # 7 байт
-            key8 = cls.make_des_key_from_7_bytes(seven)  # 8-байтовый DES-ключ
-            block = DES.encrypt_block(challenge8, key8)  # один DES-блок
-            resp += block
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def challenge_responder(des_keys: bytes) -> Callable[[bytes], bytes]:
+        """
+        Специализированная функция challenge8 -> NT-Response для фиксированных
+        DES-ключей (см. expand_nt_hash_keys). Расписание ключей DES строится
+        один раз при создании, а функции кешируются по ключам, поэтому
+        повторные проверки того же пользователя его не повторяют.
+        """
+        if len(des_keys) != 24:
+            raise ValueError("DES-ключи должны занимать 24 байта")
+
+        # одиночный DES через OpenSSL: 3DES с ключом k||k||k вырождается в DES(k).
+        # ECB-шифратор без finalize() можно использовать для любого числа блоков.
+        enc1, enc2, enc3 = (
+            Cipher(TripleDES(des_keys[i * 8:(i + 1) * 8] * 3), modes.ECB()).encryptor()
+            for i in range(3)
+        )
+        lock = threading.Lock()  # контекст OpenSSL нельзя использовать из двух потоков сразу
+
+        def respond(challenge8: bytes) -> bytes:
+            if len(challenge8) != 8:
+                raise ValueError("challenge8 должен быть 8 байт")
+            with lock:
+                # три вызова без генератора и join: 3 блока по 8 байт = 24 байта
+                return enc1.update(challenge8) + enc2.update(challenge8) + enc3.update(challenge8)
 
-        return resp  # 24 байта
+        return respond
+
+    @classmethod
+    def challenge_response_with_keys(cls, challenge8: bytes, des_keys: bytes) -> bytes:
+        """
+        NT-Response по уже подготовленным DES-ключам (см. expand_nt_hash_keys).
+        """
+        return cls.challenge_responder(des_keys)(challenge8)
+
+    @classmethod
+    def challenge_response(cls, challenge8: bytes, nt_hash: bytes) -> bytes:
+        """
+        NT-Response (24 байта) из RFC 2759:
+        """
+        return cls.challenge_response_with_keys(challenge8, cls.expand_nt_hash_keys(nt_hash))
 
     # ---------- Функции для клиента и сервера ----------
 
@@ -121,7 +161,7 @@ class MSCHAPv2:
     def verify_nt_response(cls, received_nt_response: bytes, expected: bytes) -> bool:
         if len(received_nt_response) != 24:
             return False
-        return expected == received_nt_response
+        return hmac.compare_digest(expected, received_nt_response)  # сравнение за постоянное время
 
     @classmethod
     def compute_nt_response(
@@ -130,20 +170,32 @@ class MSCHAPv2:
         peer_challenge: bytes,
         username: str,
         stored_nt_hash: bytes,
+        stored_des_keys: Optional[bytes] = None,
     ) -> bytes:
         """
         Серверная функция: проверяет NT-Response от клиента, зная:
         - auth_challenge (который он сам выдавал),
         - peer_challenge (от клиента),
         - username,
-        - stored_nt_hash
+        - stored_nt_hash,
+        - stored_des_keys (необязательно) — DES-ключи, заранее вычисленные из stored_nt_hash
         """
 
         chall8 = cls.challenge_hash(peer_challenge, auth_challenge, username)
-        expected = cls.challenge_response(chall8, stored_nt_hash)
+        if stored_des_keys is None:
+            stored_des_keys = cls.expand_nt_hash_keys(stored_nt_hash)
+        expected = cls.challenge_response_with_keys(chall8, stored_des_keys)
         return expected
 
 
+# 7-битный сегмент -> байт DES-ключа с битом чётности
+_PARITY = bytes(MSCHAPv2._apply_des_parity_to_7bits(i) for i in range(128))
+# сдвиги восьми 7-битных сегментов 56-битного ключа, старший первым
+_SEGMENT_SHIFTS = tuple(7 * (7 - i) for i in range(8))
+# то же для 168-битного дополненного NT-хеша (24 сегмента)
+_NT_KEY_SHIFTS = tuple(7 * (23 - i) for i in range(24))
+
+
 if __name__ == "__main__":
     import os
 
@@ -161,5 +213,38 @@ if __name__ == "__main__":
     print("NT-Response length:", len(client_resp))
 
     # Сервер проверяет
-    ok = MSCHAPv2.compute_nt_response(auth_challenge, peer_challenge, username, stored_nt, client_resp)
+    server_resp = MSCHAPv2.compute_nt_response(auth_challenge, peer_challenge, username, stored_nt)
+    ok = MSCHAPv2.verify_nt_response(client_resp, server_resp)
     print("Verify:", ok)
+
+    # ---------- Сверка с эталоном ----------
+
+    from des import DES
+
+    # Тестовый вектор RFC 2759, раздел 9.2 (NT-хеш настоящий, MD4 от "clientPass")
+    rfc_chall8 = MSCHAPv2.challenge_hash(
+        bytes.fromhex("21402324255E262A28295F2B3A337C7E"),  # PeerChallenge
+        bytes.fromhex("5B5D7C7D7B3F2F3E3C2C602132262628"),  # AuthenticatorChallenge
+        "User",
+    )
+    assert rfc_chall8 == bytes.fromhex("D02E4386BCE91226")
+    rfc_nt_hash = bytes.fromhex("44EBBA8D5312B8D611474411F56989AE")
+    assert MSCHAPv2.challenge_response(rfc_chall8, rfc_nt_hash) == bytes.fromhex(
+        "82309ECD8D708B5EA08FAA3981CD83544233114A3D85D6DF"
+    )
+
+    # бит чётности: нечётное число единиц в каждом байте ключа
+    for b7 in range(128):
+        assert bin(MSCHAPv2._apply_des_parity_to_7bits(b7)).count("1") % 2 == 1
+
+    # OpenSSL-путь против эталонного des.py на случайных NT-хешах
+    for _ in range(100):
+        nt_hash = os.urandom(16)
+        chall8 = os.urandom(8)
+        z = nt_hash + b"\x00" * 5
+        keys = [MSCHAPv2.make_des_key_from_7_bytes(z[i * 7:(i + 1) * 7]) for i in range(3)]
+        assert MSCHAPv2.expand_nt_hash_keys(nt_hash) == b"".join(keys)
+        expected = b"".join(DES.encrypt_block(chall8, key8) for key8 in keys)
+        assert MSCHAPv2.challenge_response(chall8, nt_hash) == expected
+
+    print("Reference checks: OK")
@@ -1,12 +1,18 @@
 from __future__ import annotations
-import base64
+import asyncio
+import atexit
+import binascii
 import logging
 import os
-import uuid
-from typing import Dict
+import queue
+import secrets
+import threading
+from logging.handlers import QueueHandler, QueueListener
 
-from fastapi import FastAPI, HTTPException
+from cachetools import TTLCache
+from fastapi import Depends, FastAPI, HTTPException
 from pydantic import BaseModel
+from sqlalchemy.orm import Session
 
 from db import Database
 from mschap import MSCHAPv2
@@ -14,9 +20,22 @@ from mschap import MSCHAPv2
 
 # ЛОГИРОВАНИЕ
 
+# Запись в поток вывода идёт в отдельном потоке QueueListener,
+# обработчики запросов только кладут записи в очередь.
+# Подробные сообщения о каждом запросе — на уровне DEBUG (LOG_LEVEL=DEBUG).
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(logging.Formatter("%(asctime)s | %(levelname)s | %(message)s"))
+_log_listener = QueueListener(_log_queue, _log_output)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+_log_enqueue = QueueHandler(_log_queue)
+_log_enqueue.setFormatter(logging.Formatter("%(message)s"))  # итоговый формат задаёт _log_output
+
 logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s | %(levelname)s | %(message)s",
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    handlers=[_log_enqueue],
 )
 log = logging.getLogger("mschap-server")
 log.info("=== Starting MS-CHAPv2 Server ===")
@@ -29,28 +48,43 @@ class AuthSession:
     """
     Состояние одной MS-CHAPv2-сессии на сервере.
     """
-    def __init__(self, username: str, auth_challenge: bytes):
+    def __init__(
+        self,
+        username: str,
+        auth_challenge: bytes,
+        nt_hash: bytes,
+        nt_des_keys: bytes,
+    ):
         self.username = username
         self.auth_challenge = auth_challenge  # 16 байт
+        # NT-хеш читается из БД при выдаче challenge, чтобы /auth/response обходился без запроса
+        self.nt_hash = nt_hash                # 16 байт
+        self.nt_des_keys = nt_des_keys        # 24 байта
 
 
 class AuthSessionManager:
     """
     ООП-класс для хранения сессий MS-CHAPv2.
+    Незавершённые сессии вытесняются по TTL, размер хранилища ограничен.
     """
+    SESSION_TTL = 120          # секунд на ответ клиента
+    MAX_SESSIONS = 100_000
+
     def __init__(self):
-        self._sessions: Dict[str, AuthSession] = {}
+        self._sessions: TTLCache[str, AuthSession] = TTLCache(maxsize=self.MAX_SESSIONS, ttl=self.SESSION_TTL)
+        self._lock = threading.RLock()  # TTLCache не потокобезопасен
 
-    def create_session(self, username: str) -> str:
-        import os
+    def create_session(self, username: str, nt_hash: bytes, nt_des_keys: bytes) -> str:
         auth_challenge = os.urandom(16)  # просто случайный challenge
-        session_id = str(uuid.uuid4())
-        self._sessions[session_id] = AuthSession(username, auth_challenge)
-        log.info("[CHALLENGE] New session: %s for user '%s'", session_id, username)
+        session_id = secrets.token_urlsafe(18)  # 144 бита случайности, 24 символа
+        with self._lock:
+            self._sessions[session_id] = AuthSession(username, auth_challenge, nt_hash, nt_des_keys)
+        log.debug("[CHALLENGE] New session: %s for user '%s'", session_id, username)
         return session_id
 
     def get_session(self, session_id: str) -> AuthSession:
-        sess = self._sessions.get(session_id)
+        with self._lock:
+            sess = self._sessions.get(session_id)
         if not sess:
             raise KeyError("session not found")
         return sess
@@ -62,8 +96,9 @@ class AuthSessionManager:
         return self.get_session(session_id).username
 
     def delete_session(self, session_id: str) -> None:
-        self._sessions.pop(session_id, None)
-        log.info("[CHALLENGE] Session %s deleted", session_id)
+        with self._lock:
+            self._sessions.pop(session_id, None)
+        log.debug("[CHALLENGE] Session %s deleted", session_id)
 
 
 
@@ -121,17 +156,17 @@ app = FastAPI(title="MS-CHAPv2 Demo Server")
 
 
 @app.post("/auth/register", response_model=RegisterResult)
-def register(req: RegisterRequest) -> RegisterResult:
-    log.info("[REGISTER] Request: username='%s'", req.username)
+async def register(req: RegisterRequest, session: Session = Depends(db.request_session)) -> RegisterResult:
+    log.debug("[REGISTER] Request: username='%s'", req.username)
 
-    user = db.get_user_by_username(req.username)
-    if user:
+    # запросы к БД блокирующие: выполняем их в пуле потоков, не занимая event loop
+    if await asyncio.to_thread(db.user_exists, req.username, session):
         log.warning("[REGISTER] User already exists: '%s'", req.username)
         raise HTTPException(status_code=400, detail="User already exists")
 
     nt_hash = MSCHAPv2.nt_password_hash(req.password)
     try:
-        new_user = db.create_user(req.username, nt_hash)
+        new_user = await asyncio.to_thread(db.create_user, req.username, nt_hash, session)
         log.info("[REGISTER] Created user id=%s username='%s'", new_user.id, new_user.username)
     except Exception as e:
         log.error("[REGISTER] DB error: %s", e)
@@ -145,19 +180,26 @@ def register(req: RegisterRequest) -> RegisterResult:
 
 
 @app.post("/auth/challenge", response_model=ChallengeResponse)
-def auth_challenge(req: ChallengeRequest) -> ChallengeResponse:
-    log.info("[CHALLENGE] Request: username='%s'", req.username)
-
-    user = db.get_user_by_username(req.username)
-    if not user:
+async def auth_challenge(req: ChallengeRequest) -> ChallengeResponse:
+    log.debug("[CHALLENGE] Request: username='%s'", req.username)
+
+    # попадание в кеш обслуживаем прямо в event loop; поток и сессия БД — только при промахе
+    credentials = db.get_cached_nt_credentials(req.username)
+    if credentials is None:
+        credentials = await asyncio.to_thread(db.get_nt_credentials, req.username)
+    if credentials is None:
         log.warning("[CHALLENGE] User not found: '%s'", req.username)
         raise HTTPException(status_code=404, detail="User not found")
 
-    session_id = session_manager.create_session(req.username)
+    session_id = session_manager.create_session(
+        req.username,
+        nt_hash=credentials.nt_hash,
+        nt_des_keys=credentials.nt_des_keys,
+    )
     auth_challenge = session_manager.get_auth_challenge(session_id)
 
-    auth_b64 = base64.b64encode(auth_challenge).decode("ascii")
-    log.info("[CHALLENGE] session_id=%s auth_challenge=%s", session_id, auth_b64)
+    auth_b64 = binascii.b2a_base64(auth_challenge, newline=False).decode("ascii")
+    log.debug("[CHALLENGE] session_id=%s auth_challenge=%s", session_id, auth_b64)
 
     return ChallengeResponse(
         session_id=session_id,
@@ -170,25 +212,24 @@ def auth_challenge(req: ChallengeRequest) -> ChallengeResponse:
 
 
 @app.post("/auth/response", response_model=AuthResult)
-def auth_response(req: AuthResponseRequest) -> AuthResult:
-    log.info("[AUTH] Response: session_id=%s username='%s'", req.session_id, req.username)
+async def auth_response(req: AuthResponseRequest) -> AuthResult:
+    log.debug("[AUTH] Response: session_id=%s username='%s'", req.session_id, req.username)
 
-    # сессия
+    # сессия (в ней же лежит NT-хеш пользователя)
     try:
-        sess_username = session_manager.get_username(req.session_id)
-        auth_challenge = session_manager.get_auth_challenge(req.session_id)
+        sess = session_manager.get_session(req.session_id)
     except KeyError:
         log.error("[AUTH] Invalid session_id: %s", req.session_id)
         raise HTTPException(status_code=400, detail="Invalid session_id")
 
-    if sess_username != req.username:
-        log.error("[AUTH] Username mismatch: expected '%s', got '%s'", sess_username, req.username)
+    if sess.username != req.username:
+        log.error("[AUTH] Username mismatch: expected '%s', got '%s'", sess.username, req.username)
         raise HTTPException(status_code=400, detail="Username mismatch")
 
     # декодируем данные клиента
     try:
-        peer_challenge = base64.b64decode(req.peer_challenge)
-        nt_response = base64.b64decode(req.nt_response)
+        peer_challenge = binascii.a2b_base64(req.peer_challenge)
+        nt_response = binascii.a2b_base64(req.nt_response)
     except Exception:
         log.error("[AUTH] Failed to decode base64 in request")
         raise HTTPException(status_code=400, detail="Bad base64")
@@ -198,21 +239,15 @@ def auth_response(req: AuthResponseRequest) -> AuthResult:
                   len(peer_challenge), len(nt_response))
         raise HTTPException(status_code=400, detail="Wrong lengths")
 
-    # достаём NT-хеш пользователя
-    user = db.get_user_by_username(req.username)
-    if not user:
-        log.error("[AUTH] User '%s' not found in DB during auth", req.username)
-        raise HTTPException(status_code=404, detail="User not found")
-
-    stored_nt_hash = user.nt_hash
-    log.info("[AUTH] Verifying NT-Response for user '%s'...", req.username)
+    log.debug("[AUTH] Verifying NT-Response for user '%s'...", req.username)
 
     # Получаем правильный NT-Response
     server_nt_response = MSCHAPv2.compute_nt_response(
-        auth_challenge=auth_challenge,
+        auth_challenge=sess.auth_challenge,
         peer_challenge=peer_challenge,
         username=req.username,
-        stored_nt_hash=stored_nt_hash,
+        stored_nt_hash=sess.nt_hash,
+        stored_des_keys=sess.nt_des_keys,
     )
 
     # Сравниваем его с полученным от клиента
@@ -227,7 +262,7 @@ def auth_response(req: AuthResponseRequest) -> AuthResult:
         log.warning("[AUTH] FAILED for user '%s'", req.username)
 
     # Отправляем свой NT-Response обратно клиенту (base64)
-    server_nt_b64 = base64.b64encode(server_nt_response).decode("ascii")
+    server_nt_b64 = binascii.b2a_base64(server_nt_response, newline=False).decode("ascii")
 
     return AuthResult(
         success=ok,